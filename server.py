@@ -1,14 +1,25 @@
 import os
+import hmac
+import math
+import time
 import uuid
 import base64
+import threading
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request
 from typing import Any, Dict, Optional, Tuple
 from contextlib import contextmanager
+from collections import OrderedDict
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
+# Số proxy tin cậy phía trước app (Render: đặt TRUSTED_PROXY_COUNT=1).
+# Mặc định 0: không tin X-Forwarded-For, tránh client tự chọn IP của mình
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
 
 # Cấu hình kết nối: Lấy DATABASE_URL từ .env (local) hoặc Render Settings
 # Tự động thêm sslmode=require nếu chưa có để đảm bảo kết nối được Cloud
@@ -33,6 +44,7 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, PATCH, DELETE, OPTIONS'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    response.headers['Access-Control-Expose-Headers'] = 'Retry-After'
     return response
 
 @app.route('/<path:path>', methods=['OPTIONS'])
@@ -45,6 +57,116 @@ def response(status: str, message: str, data: Any = None, http_code: int = 200):
     payload = {"status": status, "message": message, "data": data}
     return jsonify(payload), http_code
 
+# ---------------------------
+# Admission control: giới hạn tốc độ + số request đồng thời chạm DB
+# ---------------------------
+# Mỗi worker tự giữ state trong bộ nhớ; tổng số kết nối tới Postgres
+# tối đa = số worker * DB_MAX_CONCURRENCY.
+DB_MAX_CONCURRENCY = int(os.environ.get('DB_MAX_CONCURRENCY', 4))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 0.05))
+RATE_LIMIT_MAX_BUCKETS = 10000
+# Token cho endpoint /admission/stats; không đặt thì endpoint bị khoá
+ADMISSION_STATS_TOKEN = os.environ.get('ADMISSION_STATS_TOKEN', '')
+
+# (tokens/giây, burst) theo endpoint; "default" áp dụng cho các route còn lại
+IP_RATE_LIMITS = {
+    "default": (20.0, 40),
+    "list_books": (10.0, 30),
+    "login_user": (2.0, 10),
+    "register_user": (0.5, 5),
+}
+USER_RATE_LIMITS = {
+    "default": (5.0, 20),
+    "create_batch_borrow_requests": (0.5, 5),
+    "submit_cart": (0.5, 5),
+}
+# Không giới hạn các route không chạm DB
+ADMISSION_EXEMPT_ENDPOINTS = {"health_check", "handle_options", "admission_stats"}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Lấy 1 token; trả về 0 nếu được phép, ngược lại số giây cần chờ"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+_buckets: "OrderedDict[Tuple[str, str, str], TokenBucket]" = OrderedDict()
+_buckets_lock = threading.Lock()
+_db_slots = threading.BoundedSemaphore(DB_MAX_CONCURRENCY)
+_admission_stats = {"rate_limited_ip": {}, "rate_limited_user": {}, "overloaded": {}, "in_flight": 0}
+
+def _count_rejection(kind: str, endpoint: str):
+    with _buckets_lock:
+        counts = _admission_stats[kind]
+        counts[endpoint] = counts.get(endpoint, 0) + 1
+
+def _take_token(scope: str, key: Any, endpoint: str) -> float:
+    limits = IP_RATE_LIMITS if scope == "ip" else USER_RATE_LIMITS
+    rate, burst = limits.get(endpoint, limits["default"])
+    now = time.monotonic()
+    with _buckets_lock:
+        k = (scope, str(key), endpoint)
+        bucket = _buckets.get(k)
+        if bucket is None:
+            bucket = _buckets[k] = TokenBucket(rate, burst)
+            # LRU: bỏ bucket lâu không dùng nhất khi vượt giới hạn
+            while len(_buckets) > RATE_LIMIT_MAX_BUCKETS:
+                _buckets.popitem(last=False)
+        else:
+            _buckets.move_to_end(k)
+        return bucket.take(now)
+
+def rate_limited(retry_after: float, http_code: int = 429, message: str = "Too many requests"):
+    body, code = response("error", message, http_code=http_code)
+    return body, code, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+def check_user_rate_limit(user: Dict[str, Any]) -> Optional[Any]:
+    """Giới hạn theo user đã xác thực, trả về response 429 nếu vượt"""
+    endpoint = request.endpoint or "default"
+    wait = _take_token("user", user["id"], endpoint)
+    if wait:
+        _count_rejection("rate_limited_user", endpoint)
+        return rate_limited(wait)
+    return None
+
+def client_ip() -> str:
+    # remote_addr đã được ProxyFix thay bằng IP do proxy tin cậy ghi lại
+    return request.remote_addr or "unknown"
+
+@app.before_request
+def admission_control():
+    """Từ chối sớm (429/503) trước khi mở kết nối DB"""
+    endpoint = request.endpoint
+    if request.method == "OPTIONS" or endpoint is None or endpoint in ADMISSION_EXEMPT_ENDPOINTS:
+        return None
+    wait = _take_token("ip", client_ip(), endpoint)
+    if wait:
+        _count_rejection("rate_limited_ip", endpoint)
+        return rate_limited(wait)
+    if not _db_slots.acquire(timeout=DB_ACQUIRE_TIMEOUT):
+        _count_rejection("overloaded", endpoint)
+        return rate_limited(1, http_code=503, message="Server busy, please retry")
+    g.db_slot = True
+    with _buckets_lock:
+        _admission_stats["in_flight"] += 1
+    return None
+
+@app.teardown_request
+def release_db_slot(exc=None):
+    if g.pop("db_slot", False):
+        with _buckets_lock:
+            _admission_stats["in_flight"] -= 1
+        _db_slots.release()
+
 def init_db():
     """Khởi tạo cấu trúc bảng trên PostgreSQL"""
     with get_db_connection() as conn:
@@ -129,6 +251,9 @@ def require_auth(payload: Dict[str, Any], role: Optional[str] = None) -> Tuple[O
         return None, response("error", "Invalid credentials", http_code=401)
     if role and user["role"] != role:
         return None, response("error", "Forbidden", http_code=403)
+    err = check_user_rate_limit(user)
+    if err:
+        return None, err
     return user, None
 
 @app.route("/users/register", methods=["POST"])
@@ -301,6 +426,8 @@ def get_user_cart():
     
     user = get_user(username, password)
     if not user: return response("error", "Invalid credentials", http_code=401)
+    err = check_user_rate_limit(user)
+    if err: return err
     
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -431,6 +558,25 @@ def delete_borrow_request(req_id: int):
 def health_check():
     return response("success", "OK")
 
+@app.route("/admission/stats", methods=["GET"])
+def admission_stats():
+    """Số request bị từ chối theo endpoint (của worker hiện tại) để giám sát"""
+    # Dùng token riêng thay vì require_auth để không tốn kết nối DB khi quá tải
+    auth_header = request.headers.get("Authorization", "")
+    token = auth_header[7:] if auth_header.startswith("Bearer ") else ""
+    if not ADMISSION_STATS_TOKEN or not hmac.compare_digest(token.encode(), ADMISSION_STATS_TOKEN.encode()):
+        return response("error", "Forbidden", http_code=403)
+    with _buckets_lock:
+        stats = {
+            "worker_pid": os.getpid(),
+            "rate_limited_ip": dict(_admission_stats["rate_limited_ip"]),
+            "rate_limited_user": dict(_admission_stats["rate_limited_user"]),
+            "overloaded": dict(_admission_stats["overloaded"]),
+            "in_flight": _admission_stats["in_flight"],
+            "db_max_concurrency": DB_MAX_CONCURRENCY,
+        }
+    return response("success", "Admission stats", stats)
+
 try:
     init_db()
 except Exception as e:
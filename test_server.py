@@ -0,0 +1,161 @@
+import os
+from contextlib import contextmanager
+
+import pytest
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import server
+
+
+class FakeCursor:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, *args):
+        if self.fail:
+            raise RuntimeError("db down")
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+
+class FakeConn:
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.fail)
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch):
+    state = {"fail": False}
+    clock = {"now": 1000.0}
+    held_slots = []
+
+    @contextmanager
+    def fake_connection():
+        yield FakeConn(state["fail"])
+
+    monkeypatch.setattr(server, "get_db_connection", fake_connection)
+    monkeypatch.setattr(server, "get_user", lambda u, p: {"id": 1, "username": u, "role": "user"} if u and p else None)
+    monkeypatch.setattr(server, "ADMISSION_STATS_TOKEN", "secret")
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(server.app, "testing", False)
+    server._buckets.clear()
+    for kind in ("rate_limited_ip", "rate_limited_user", "overloaded"):
+        server._admission_stats[kind].clear()
+    server._admission_stats["in_flight"] = 0
+    c = server.app.test_client()
+    c.db_state = state
+    c.clock = clock
+    c.held_slots = held_slots
+    yield c
+    for _ in held_slots:
+        server._db_slots.release()
+
+
+def hold_all_db_slots(client):
+    for _ in range(server.DB_MAX_CONCURRENCY):
+        assert server._db_slots.acquire(blocking=False)
+        client.held_slots.append(True)
+
+
+def stats(client):
+    res = client.get("/admission/stats", headers={"Authorization": "Bearer secret"})
+    assert res.status_code == 200
+    return res.get_json()["data"]
+
+
+def test_token_bucket_runs_out_and_recovers():
+    bucket = server.TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait = bucket.take(now)
+    assert wait == pytest.approx(0.5)
+    assert bucket.take(now + 0.5) == 0.0
+    assert bucket.take(now + 0.5) > 0
+
+
+def test_ip_bucket_returns_429_with_retry_after(client):
+    _, burst = server.IP_RATE_LIMITS["list_books"]
+    codes = [client.get("/books?q=x").status_code for _ in range(burst + 1)]
+    assert codes == [200] * burst + [429]
+    res = client.get("/books?q=x")
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+    client.clock["now"] += 1
+    assert client.get("/books?q=x").status_code == 200
+    data = stats(client)
+    assert data["rate_limited_ip"] == {"list_books": 2}
+    assert data["rate_limited_user"] == {}
+
+
+def test_spoofed_forwarded_for_shares_proxy_ip_bucket(client, monkeypatch):
+    monkeypatch.setattr(server.app, "wsgi_app", ProxyFix(server.app.wsgi_app, x_for=1))
+    _, burst = server.IP_RATE_LIMITS["list_books"]
+    codes = [
+        client.get("/books", headers={"X-Forwarded-For": f"10.0.0.{i}, 1.2.3.4"}).status_code
+        for i in range(burst + 5)
+    ]
+    assert codes.count(429) == 5
+    assert ("ip", "1.2.3.4", "list_books") in server._buckets
+
+
+def test_user_bucket_returns_429_with_retry_after(client):
+    _, burst = server.USER_RATE_LIMITS["submit_cart"]
+    creds = {"username": "u", "password": "p"}
+    for _ in range(burst):
+        assert client.post("/users/cart/submit", json=creds).status_code == 400
+    res = client.post("/users/cart/submit", json=creds)
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+    data = stats(client)
+    assert data["rate_limited_user"] == {"submit_cart": 1}
+    assert data["rate_limited_ip"] == {}
+
+
+def test_503_when_db_slots_exhausted(client, monkeypatch):
+    monkeypatch.setattr(server, "DB_ACQUIRE_TIMEOUT", 0)
+    hold_all_db_slots(client)
+    res = client.get("/books/1")
+    assert res.status_code == 503
+    assert int(res.headers["Retry-After"]) >= 1
+    assert stats(client)["overloaded"] == {"get_book": 1}
+
+
+def test_slot_released_on_success_and_error(client):
+    assert client.get("/books").status_code == 200
+    assert stats(client)["in_flight"] == 0
+    client.db_state["fail"] = True
+    assert client.get("/books").status_code == 500
+    assert stats(client)["in_flight"] == 0
+    hold_all_db_slots(client)
+
+
+def test_bucket_table_is_bounded(client, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_MAX_BUCKETS", 5)
+    for i in range(20):
+        server._take_token("ip", f"10.0.0.{i}", "register_user")
+    assert len(server._buckets) == 5
+    assert ("ip", "10.0.0.19", "register_user") in server._buckets
+    assert ("ip", "10.0.0.0", "register_user") not in server._buckets
+
+
+def test_stats_requires_token(client):
+    assert client.get("/admission/stats").status_code == 403
+    assert client.get("/admission/stats", headers={"Authorization": "Bearer nope"}).status_code == 403
+    assert stats(client)["worker_pid"] == os.getpid()